@@ -0,0 +1,71 @@
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import traceback
+
+import lolmarkov
+
+AUTHORS_SQL = """
+SELECT author_id FROM messages
+GROUP BY author_id HAVING count(*) >= ?
+"""
+
+
+def build(author_id):
+    """Build and save the model for author_id unless it is up to date.
+
+    Runs in a pool worker set up by lolmarkov.init_worker. Returns whether a
+    model was written. Failures are reported rather than raised, so that one
+    author doesn't stop the run."""
+    try:
+        model_path = lolmarkov.author_model_path(author_id)
+        mtime = lolmarkov.model_mtime(model_path)
+        if mtime is not None:
+            latest_timestamp = lolmarkov.worker_conn.execute(
+                lolmarkov.LATEST_TIMESTAMP_SQL, (author_id,)
+            ).fetchone()
+            if latest_timestamp <= mtime:
+                return False
+
+        data = lolmarkov.build_model(author_id)
+        if data is None:
+            return False
+        lolmarkov.save_model(model_path, data)
+        return True
+    except Exception:
+        print(f"Failed to build the model for author {author_id}")
+        traceback.print_exc()
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build the talkbot's cached models for every author ahead of time."
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of worker processes",
+        type=int,
+        default=os.cpu_count(),
+    )
+    args = parser.parse_args()
+
+    os.makedirs("models", exist_ok=True)
+    conn = sqlite3.connect(lolmarkov.DATABASE_URI, uri=True)
+    author_ids = [
+        row[0] for row in conn.execute(AUTHORS_SQL, (lolmarkov.MIN_MODEL_MESSAGES,))
+    ]
+    conn.close()
+
+    built = 0
+    with multiprocessing.Pool(args.jobs, initializer=lolmarkov.init_worker) as pool:
+        # Unordered, so that progress isn't held up by the largest corpora
+        for i, written in enumerate(pool.imap_unordered(build, author_ids), 1):
+            built += written
+            print(f"Checked {i} of {len(author_ids)} authors, built {built} models")
+
+
+if __name__ == "__main__":
+    main()
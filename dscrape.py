@@ -1,10 +1,10 @@
 import argparse
 import asyncio
 import configparser
-import json
+import queue
 import sqlite3
+import threading
 import traceback
-from datetime import timezone
 
 import discord
 
@@ -45,37 +45,227 @@ CREATE TABLE IF NOT EXISTS messages(
     FOREIGN KEY(channel_id) REFERENCES channels(id)
 );"""
 
+# Full-text index over clean_content, used by the talkbot's /quote keyword
+# search. Trigrams let it answer the same substring LIKE patterns as a scan of
+# the messages table. It stores no text of its own and is kept in sync by a
+# trigger, which is dropped during a backfill.
+MESSAGES_FTS_DDL = \
+    """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    clean_content,
+    content='messages',
+    content_rowid='id',
+    tokenize='trigram'
+);"""
+
+MESSAGES_FTS_TRIGGER_DDL = \
+    """
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+BEGIN
+    INSERT INTO messages_fts(rowid, clean_content)
+    VALUES (new.id, new.clean_content);
+END;"""
+
+# Lets the per-channel boundary lookup use an index instead of a table scan.
+MESSAGES_CHANNEL_INDEX_DDL = \
+    """
+CREATE INDEX IF NOT EXISTS idx_msg_chan_ts ON messages(channel_id, timestamp);"""
+
+# Used by the talkbot to fetch an author's latest messages.
+MESSAGES_AUTHOR_INDEX_DDL = \
+    """
+CREATE INDEX IF NOT EXISTS idx_msg_author_ts
+ON messages(author_id, timestamp DESC);"""
+
+# Secondary indexes by name
+INDEXES = {
+    "idx_msg_chan_ts": MESSAGES_CHANNEL_INDEX_DDL,
+    "idx_msg_author_ts": MESSAGES_AUTHOR_INDEX_DDL,
+}
+
+# Indexes dropped while a backfill inserts into an empty archive and rebuilt
+# afterwards, which is faster than updating them per row. The talkbot's
+# indexes are kept, since it may be querying the archive at the same time.
+BACKFILL_INDEXES = ("idx_msg_chan_ts", )
+
+# Applied to every connection. WAL with synchronous=NORMAL avoids an fsync per
+# commit, which otherwise dominates ingest time.
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA cache_size = -262144;",  # 256 MiB
+    "PRAGMA foreign_keys = ON;",
+)
+
+DATABASE = "discord_archive.sqlite3"
+
+INSERT_CHANNELS_SQL = "INSERT OR IGNORE INTO channels VALUES (?, ?)"
+INSERT_USERS_SQL = "INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?)"
+INSERT_MESSAGES_SQL = \
+    "INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+
+# Milliseconds since the unix epoch at the start of the snowflake epoch
+DISCORD_EPOCH = 1420070400000
+
+# Number of buffered messages that triggers a batched insert.
+BATCH_SIZE = 5000
+
+# Number of channels whose history is fetched at the same time.
+CONCURRENT_CHANNELS = 8
+
+
+def tune_connection(conn):
+    """Apply PRAGMAS to a sqlite3 connection."""
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+
+
+def connect():
+    """Open and tune a connection to the archive.
+
+    Transactions are managed explicitly with BEGIN and commit()."""
+    conn = sqlite3.connect(DATABASE,
+                           isolation_level=None,
+                           cached_statements=512)
+    tune_connection(conn)
+    return conn
+
 
 class MyClient(discord.Client):
     def __init__(self, update, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._started = False
+        # Whether this run is filling an empty archive
+        self._backfill = False
 
-        self._conn = sqlite3.connect("discord_archive.sqlite3")
-        self._conn.execute("PRAGMA foreign_keys = ON;")
+        # Used for the schema and for reads. All inserts go through the
+        # writer thread, which owns a separate connection.
+        self._conn = connect()
         self._conn.execute(USERS_TABLE_DDL)
         self._conn.execute(CHANNELS_TABLE_DDL)
         self._conn.execute(MESSAGES_TABLE_DDL)
+        self.create_indexes()
         self._conn.commit()
 
-        # Background task to periodically commit
-        self.commit_task = self.loop.create_task(self.commit_task())
+        # Ids of users inserted up front from the member list
+        self._members = set()
+
+        # Batches of (sql, rows) pairs, terminated by a None sentinel
+        self._write_q = queue.Queue(maxsize=32)
+        # Set by the writer if a batch fails, after which nothing is committed
+        self._write_error = None
+        self._writer = threading.Thread(target=self.writer_loop, daemon=True)
+        self._writer.start()
 
         self.update = update
 
-    async def commit_task(self):
-        await self.wait_until_ready()
-        last_count = int(
-            next(self._conn.execute("SELECT COUNT(*) FROM messages;"))[0])
+    def writer_loop(self):
+        """Execute batches from the write queue until the sentinel arrives.
+
+        Runs in its own thread so that sqlite3 never blocks the event loop.
+        Each batch is executed in a single transaction. Once a batch fails,
+        the rest are discarded, so that the resume points computed by the next
+        run can't move past the lost messages."""
+        conn = connect()
+        # Reused for every statement instead of a new cursor per execute()
+        cursor = conn.cursor()
+        # Counted once, then kept up to date from the inserted row counts
+        count = int(next(cursor.execute("SELECT COUNT(*) FROM messages;"))[0])
+
+        while True:
+            batch = self._write_q.get()
+            if batch is None:
+                break
+            if self._write_error is not None:
+                continue
+
+            try:
+                diff = 0
+                cursor.execute("BEGIN")
+                for sql, rows in batch:
+                    cursor.executemany(sql, rows)
+                    if sql == INSERT_MESSAGES_SQL:
+                        diff += cursor.rowcount
+                conn.commit()
+            except sqlite3.Error as e:
+                traceback.print_exc()
+                conn.rollback()
+                self._write_error = e
+                continue
+
+            count += diff
+            print("Got {} messages with total {}".format(diff, count))
+
+        conn.close()
+
+    def create_full_text_index(self):
+        """Create the full-text index and its trigger.
+
+        Existing messages are indexed if either was missing. An index built
+        with another tokenizer is replaced. If SQLite is too old for the
+        trigram tokenizer, the index is skipped and the talkbot falls back to
+        scanning an author's messages."""
+        schema = dict(
+            self._conn.execute(
+                "SELECT name, sql FROM sqlite_master "
+                "WHERE name IN ('messages_fts', 'messages_fts_insert');"))
+        if "trigram" not in schema.get("messages_fts", "trigram"):
+            self._conn.execute("DROP TABLE messages_fts;")
+            del schema["messages_fts"]
+        try:
+            self._conn.execute(MESSAGES_FTS_DDL)
+        except sqlite3.OperationalError as e:
+            print("Warning: skipping the full-text index: {}".format(e))
+            # The trigger would fail every insert without its table
+            self._conn.execute("DROP TRIGGER IF EXISTS messages_fts_insert;")
+            return
+        self._conn.execute(MESSAGES_FTS_TRIGGER_DDL)
+        if len(schema) < 2:
+            print("Building full-text index")
+            self._conn.execute(
+                "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild');")
+
+    def create_indexes(self):
+        """Create any missing secondary indexes and refresh statistics."""
+        self.create_full_text_index()
+        for ddl in INDEXES.values():
+            self._conn.execute(ddl)
+        self._conn.execute("PRAGMA optimize;")
+
+    def drop_indexes(self):
+        """Drop the backfill indexes ahead of a bulk insert.
+
+        The full-text index trigger is dropped as well, and the index is
+        rebuilt from scratch by create_indexes()."""
+        for name in BACKFILL_INDEXES:
+            self._conn.execute("DROP INDEX IF EXISTS {}".format(name))
+        self._conn.execute("DROP TRIGGER IF EXISTS messages_fts_insert;")
+
+    async def write(self, batch):
+        """Queue a batch for the writer thread without blocking the loop.
+
+        Raises the writer's error if an earlier batch failed."""
+        if batch is not None and self._write_error is not None:
+            raise self._write_error
+        await self.loop.run_in_executor(None, self._write_q.put, batch)
+
+    async def stop_writer(self):
+        """Wait for the writer to finish everything that was queued."""
+        if self._writer.is_alive():
+            await self.write(None)
+            await self.loop.run_in_executor(None, self._writer.join)
+
+    async def flush(self, messages, users):
+        """Hand a batch of users and messages to the writer.
+
+        Users are inserted first so that the messages referencing them don't
+        break the foreign key constraint."""
+        if not messages:
+            return
 
-        while not self.is_closed():
-            self._conn.commit()
-            for row in self._conn.execute("SELECT COUNT(*) FROM messages;"):
-                count = int(row[0])
-                diff = count - last_count
-                print("Got {} messages with total {}".format(diff, count))
-                last_count = count
-            await asyncio.sleep(5)
+        await self.write([(INSERT_USERS_SQL, users),
+                          (INSERT_MESSAGES_SQL, messages)])
 
     async def user_tuple_generator(self):
         """Yields tuples to be inserted into the users table."""
@@ -90,59 +280,75 @@ class MyClient(discord.Client):
                 continue
             yield (int(channel.id), channel.name)
 
-    async def archive_permission(self, channel):
+    def archive_permission(self, channel):
         """Return if we have read and history permission for a Channel."""
         perms = channel.permissions_for(channel.guild.me)
         return perms.read_messages and perms.read_message_history
 
-    async def message_tuple_generator(self, update=False):
+    def channel_bounds(self, update=False):
+        """Return a dict of channel id to the message to resume archiving from.
+
+        If update is true, this is the latest message in the table for the
+        channel. Otherwise, it is the oldest message in the table for the
+        channel."""
+        # SQLite returns the id of the row matching max/min.
+        return {
+            row[0]: discord.Object(row[1])
+            for row in self._conn.execute(
+                "SELECT channel_id, id, {}(timestamp) FROM messages "
+                "GROUP BY channel_id".format("max" if update else "min"))
+        }
+
+    async def message_tuple_generator(self, channel, before=None, after=None):
         """Yields tuples to be inserted into the messages/users table.
 
-        If update is true, grab messages after the latest message in the table
-        for the channel. Otherwise, grab messages before the oldest message in
-        the table for the channel.
-
         Yields a tuple of (message tuple, user tuple)."""
-        # Archive all channels that we have access to
-        channels = (c for c in self.get_all_channels()
-                    if await self.archive_permission(c))
-
-        async for channel in channels:
-            if channel.type != discord.ChannelType.text:
-                continue
-
+        # discord.py ids are already ints, so no casts are needed.
+        cid = channel.id
+
+        async for message in channel.history(before=before,
+                                             after=after,
+                                             limit=None):
+            author = message.author
+            aid = author.id
+            name = author.name
+
+            # TODO: fix attachments
+            attachments = None
+            # Get UTC unix timestamp from the creation time in the snowflake
+            ts = ((message.id >> 22) + DISCORD_EPOCH) / 1000
+            yield ((message.id, ts, aid, name, cid, message.content,
+                    message.clean_content, attachments),
+                   (aid, name, author.display_name, author.discriminator))
+
+    async def archive_channel(self, channel, boundary, sem):
+        """Archive a channel, queueing batches of rows for the writer.
+
+        If update is true, grab messages after boundary. Otherwise, grab
+        messages before it."""
+        async with sem:
             print("Archiving channel {}".format(channel.name))
 
-            before, after = None, None
-            if update:
-                for row in self._conn.execute(
-                        """
-                  SELECT id, max(timestamp) FROM messages
-                  WHERE channel_id = ?""", (int(channel.id), )):
-                    after = discord.Object(row[0]) if row[0] else None
-
+            if self.update:
+                before, after = None, boundary
             else:
-                for row in self._conn.execute(
-                        """
-                  SELECT id, min(timestamp) FROM messages
-                  WHERE channel_id = ?""", (int(channel.id), )):
-                    before = discord.Object(row[0]) if row[0] else None
-
-            async for message in channel.history(before=before,
-                                                 after=after,
-                                                 limit=None):
-
-                # TODO: fix attachments
-                attachments = None
-                # Get UTC unix timestamp from a naive datetime object
-                ts = message.created_at.replace(
-                    tzinfo=timezone.utc).timestamp()
-                yield ((int(message.id), ts, int(message.author.id),
-                        message.author.name, int(message.channel.id),
-                        message.content, message.clean_content, attachments),
-                       (message.author.id, message.author.name,
-                        message.author.display_name,
-                        message.author.discriminator))
+                before, after = boundary, None
+
+            messages = []
+            users = {}
+            async for message, user in self.message_tuple_generator(
+                    channel, before=before, after=after):
+                # Users that have left the server won't be in the users table,
+                # and this breaks the foreign key constraint. Every batch
+                # carries its own copy of them, since batches from other
+                # channels may be committed in any order.
+                if user[0] not in self._members:
+                    users[user[0]] = user
+                messages.append(message)
+                if len(messages) >= BATCH_SIZE:
+                    await self.flush(messages, list(users.values()))
+                    messages, users = [], {}
+            await self.flush(messages, list(users.values()))
 
     async def on_ready(self):
         if self._started:
@@ -150,43 +356,53 @@ class MyClient(discord.Client):
         self._started = True
 
         try:
-            # TODO: async-aware sqlite3 library that async generators
             print("Inserting channels")
-            async for t in self.channel_tuple_generator():
-                self._conn.execute(
-                    "INSERT OR IGNORE INTO channels VALUES(?, ?)", t)
+            channel_rows = [t async for t in self.channel_tuple_generator()]
 
             print("Inserting users")
-            users = set()  # Keep track of user ids we've inserted
-            async for t in self.user_tuple_generator():
-                users.add(t[0])
-                self._conn.execute(
-                    "INSERT OR IGNORE INTO users VALUES(?, ?, ?, ?)", t)
+            # Members of several guilds are yielded once per guild
+            user_rows = {t[0]: t async for t in self.user_tuple_generator()}
+            self._members = set(user_rows)
 
-            self._conn.commit()
+            await self.write([(INSERT_CHANNELS_SQL, channel_rows),
+                              (INSERT_USERS_SQL, list(user_rows.values()))])
 
             print("Inserting messages")
 
-            async for t in self.message_tuple_generator(update=self.update):
-                # Users that have left the server won't be in the users table,
-                # and this breaks the foreign key constraint. We insert them
-                # here if necessary.
-                message, user = t
-                if user[0] not in users:
-                    self._conn.execute(
-                        "INSERT OR IGNORE INTO users VALUES (?, ?, ?, ?)",
-                        user)
-                    users.add(user[0])
-                self._conn.execute(
-                    "INSERT OR IGNORE INTO messages VALUES "
-                    "(?, ?, ?, ?, ?, ?, ?, ?)", message)
-            self._conn.commit()
-
+            # Archive all channels that we have access to
+            text = discord.ChannelType.text
+            channels = [
+                c for c in self.get_all_channels()
+                if c.type == text and self.archive_permission(c)
+            ]
+            bounds = self.channel_bounds(update=self.update)
+            self._backfill = not self.update and not self._conn.execute(
+                "SELECT EXISTS (SELECT 1 FROM messages);").fetchone()[0]
+            if self._backfill:
+                self.drop_indexes()
+            sem = asyncio.BoundedSemaphore(CONCURRENT_CHANNELS)
+
+            tasks = [
+                self.archive_channel(c, bounds.get(c.id), sem)
+                for c in channels
+            ]
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+            for channel, result in zip(channels, results):
+                if isinstance(result, Exception):
+                    print("Failed to archive channel {}: {}".format(
+                        channel.name, result))
+
+            await self.stop_writer()
+            if self._write_error is not None:
+                raise self._write_error
             print("Done!")
         except Exception as e:
             print(e)
         finally:
-            self.commit_task.cancel()
+            await self.stop_writer()
+            if self._backfill:
+                print("Rebuilding indexes")
+                self.create_indexes()
             await self.logout()
 
 
@@ -2,14 +2,17 @@ import argparse
 import asyncio
 import concurrent.futures
 import configparser
-import functools
-import json
 import logging
 import os
+import pickle
 import random
+import re
 import sqlite3
+import sys
+import tempfile
+import time
 import traceback
-from collections import namedtuple
+from collections import OrderedDict, namedtuple
 from datetime import datetime
 from typing import Iterable, Union
 from uuid import uuid4
@@ -33,6 +36,96 @@ import util
 
 MAX_MESSAGE_LEN = 1900
 MAX_QUERY_ROWS = 500
+# Total pickled size of the models kept in memory. Loaded models take up a few
+# times more than this.
+MODEL_CACHE_BYTES = 256 * 1024 * 1024
+# Authors with fewer messages than this don't get a model
+MIN_MODEL_MESSAGES = 25
+# Seconds for which an author's message count is reused by /quote
+MESSAGE_COUNT_TTL = 300
+# Seconds for which a model checked against the archive is assumed current
+MODEL_FRESHNESS_TTL = 60
+# Number of the most prolific authors whose models are prepared at startup
+WARM_MODELS = 8
+# Leave a core for the bot's event loop while models are being built
+POOL_WORKERS = max(2, (os.cpu_count() or 1) - 1)
+# Threads for blocking work off the event loop: sentence generation and model
+# loading. Generation holds the GIL, so more threads would only compete with
+# the event loop for it.
+EXECUTOR_THREADS = 4
+# Overlap with the corpus allowed by successive rounds of sentence generation
+OVERLAP_RATIOS = (0.7, 0.8, 0.9, 1.0)
+TRIES_PER_RATIO = 10
+# Shortest keyword that the trigram full-text index can narrow down
+MIN_INDEXED_KEYWORD_LEN = 3
+DATABASE_URI = "file:./discord_archive.sqlite3?mode=ro"
+
+# Applied to every archive connection
+PRAGMAS = (
+    "PRAGMA mmap_size = 268435456;",  # 256 MiB
+    "PRAGMA cache_size = -65536;",  # 64 MiB
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA query_only = ON;",
+)
+
+# Queries run by commands. Keeping them as constants lets the connection's
+# statement cache reuse their prepared statements.
+USER_SQL = """
+SELECT id, username, discriminator FROM users
+WHERE id == ?
+LIMIT 1
+"""
+
+LATEST_TIMESTAMP_SQL = """
+SELECT max(timestamp) FROM messages
+WHERE author_id == ?
+"""
+
+CORPUS_SQL = """
+SELECT clean_content FROM messages
+WHERE author_id == ?
+ORDER BY timestamp DESC
+LIMIT 100000
+"""
+
+# CROSS JOIN keeps the full-text matches as the outer loop. Otherwise SQLite
+# walks all of the author's messages and probes the index once per row.
+QUOTE_KEYWORD_SQL = """
+SELECT m.clean_content, m.timestamp FROM messages_fts
+CROSS JOIN messages AS m ON m.id == messages_fts.rowid
+WHERE messages_fts.clean_content LIKE ? AND m.author_id == ?
+ORDER BY RANDOM() LIMIT 1
+"""
+
+# For short keywords and archives that predate the full-text index
+QUOTE_KEYWORD_LIKE_SQL = """
+SELECT clean_content, timestamp FROM messages
+WHERE author_id == ? AND clean_content LIKE ?
+ORDER BY RANDOM() LIMIT 1
+"""
+
+TOP_AUTHORS_SQL = """
+SELECT author_id FROM messages
+GROUP BY author_id ORDER BY count(*) DESC
+LIMIT ?
+"""
+
+MESSAGE_COUNT_SQL = """
+SELECT count(*) FROM messages WHERE author_id == ?
+"""
+
+# Skip through the author index to the chosen id, then read one row.
+QUOTE_SQL = """
+SELECT clean_content, timestamp FROM messages WHERE id == (
+    SELECT id FROM messages WHERE author_id == ?
+    LIMIT 1 OFFSET ?
+)
+"""
+
+UWU_TABLE = str.maketrans("LlRr", "WwWw")
+# An n or N followed by a vowel, which UWU turns into ny or NY
+UWU_NYA_RE = re.compile("([nN])([aeiouAEIOU])")
+UWU_FACES = ("(・`ω´・)", ";;w;;", "owo", "UwU", ">w<", "^w^")
 
 DuckUser = namedtuple("DuckUser", ["id", "name", "discriminator"])
 
@@ -53,24 +146,158 @@ def format_sqlexec(result_rows, maxlen):
         return f"```\n{codeblock[:maxlen - len(note)]}```{note}"
 
 
+async def connect_archive():
+    """Open a read-only connection to the archive and apply PRAGMAS."""
+    conn = await aiosqlite.connect(DATABASE_URI, uri=True, cached_statements=256)
+    for pragma in PRAGMAS:
+        await conn.execute(pragma)
+    return conn
+
+
+# Archive connection of a process pool worker, opened by init_worker
+worker_conn = None
+
+
+def init_worker():
+    """Open the read-only archive connection used by a pool worker."""
+    global worker_conn
+    worker_conn = sqlite3.connect(DATABASE_URI, uri=True)
+    for pragma in PRAGMAS:
+        worker_conn.execute(pragma)
+    worker_conn.row_factory = first_column
+
+
+def warm_worker():
+    """No-op submitted to the process pool to start its workers eagerly."""
+
+
+def first_column(cursor, row):
+    """Row factory that returns the first column instead of a tuple."""
+    return row[0]
+
+
 class SentenceText(markovify.Text):
     """Like markovify.Text, but a list of Iterable of sentences can be passed in."""
 
     def generate_corpus(self, sentences: Iterable[str]):
         return map(self.word_split, filter(self.test_sentence_input, sentences))
 
+    def word_split(self, sentence):
+        # Interned words are shared by every sentence and chain state that
+        # uses them, and pickle stores each of them only once.
+        return [sys.intern(word) for word in self.word_split_pattern.split(sentence)]
+
+
+def generate_sentence(model, start=None):
+    """Get one sentence from model, with optional start parameter.
+
+    The overlap allowed with the corpus is relaxed until a sentence is found.
+    Raises KeyError if no sentence in the corpus starts with start, and
+    ParamError if start has more words than the model's state size."""
+    init_state = None
+    if start:
+        words = tuple(model.word_split(start))
+        if len(words) > model.state_size:
+            raise markovify.text.ParamError(f"Too many words in {start}")
+        # The state make_sentence_with_start begins from in strict mode
+        padding = (markovify.chain.BEGIN,) * (model.state_size - len(words))
+        init_state = padding + words
+        if init_state not in model.chain.model:
+            raise KeyError(start)
+
+    for max_overlap_ratio in OVERLAP_RATIOS:
+        for _ in range(TRIES_PER_RATIO):
+            sentence = model.make_sentence(
+                init_state, max_overlap_ratio=max_overlap_ratio
+            )
+            if sentence:
+                return sentence
+
+    # If we still don't get a sentence, just give up and stop testing the
+    # output so that we allow total repeats.
+    if start:
+        return model.make_sentence_with_start(start, strict=False, test_output=False)
+    return model.make_sentence(test_output=False)
+
+
+def author_model_path(author_id):
+    """Return the path of the cached model for author_id."""
+    return os.path.join("models", f"{author_id}.pkl")
+
+
+def model_mtime(path):
+    """Return the modification time of a model file, or None if there is none.
+
+    Empty files, e.g. from an interrupted write, count as missing."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime if st.st_size else None
+
+
+def load_model(path):
+    """Load a pickled SentenceText from disk.
+
+    Returns the model along with the size and modification time of the file."""
+    with open(path, mode="rb") as f:
+        st = os.fstat(f.fileno())
+        return pickle.load(f), st.st_size, st.st_mtime
+
+
+def save_model(path, data):
+    """Write a pickled model to disk, atomically replacing any existing file.
+
+    Each call writes to its own temporary file, so the bot and build_models.py
+    can save the same model at the same time. Returns the modification time
+    of the new file."""
+    fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, mode="wb") as f:
+            f.write(data)
+        mtime = os.stat(tmp_path).st_mtime
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return mtime
+
+
+def remove_model(path):
+    """Delete a model file, if it is still there."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def build_model(author_id):
+    """Build the model for author_id from the archive and return it pickled.
+
+    Runs in the process pool. Reading the corpus there keeps it out of the
+    pipe, and the pickle sent back is also what gets saved to disk. Returns
+    None if there isn't enough data, including when every message is rejected
+    by the model's sentence filter."""
+    messages = worker_conn.execute(CORPUS_SQL, (author_id,)).fetchall()
+
+    if len(messages) < MIN_MODEL_MESSAGES:
+        return None
+    # Repeated messages (reactions, copypasta) only inflate the chain and the
+    # text used for the overlap check, so keep one of each.
+    messages = list(dict.fromkeys(messages))
+    try:
+        model = SentenceText(messages)
+    except KeyError:
+        # Without any sentences, the chain has no begin state to precompute
+        return None
+    return pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+
 
 async def database_user(conn, argument):
     """
     Look up a user in the database and return a NamedTuple mimicking a discord.User
     """
-    cursor = await conn.execute(
-        """SELECT id, username, discriminator FROM users
-        WHERE username||'#'||discriminator == ?
-        OR id is ?
-        LIMIT 1""",
-        (argument, argument),
-    )
+    cursor = await conn.execute(USER_SQL, (argument,))
     users = await cursor.fetchall()
 
     if not users:
@@ -82,29 +309,27 @@ async def database_user(conn, argument):
 
 
 def last_replace(s, old, new):
-    li = s.rsplit(old, 1)
-    return new.join(li)
+    i = s.rfind(old)
+    if i == -1:
+        return s
+    return s[:i] + new + s[i + len(old) :]
+
+
+def uwu_nya(match):
+    n, v = match.group(1, 2)
+    if n == "N" and v.isupper():
+        return f"NY{v}"
+    return f"{n}y{v}"
 
 
 def UWU(msg):
-    vowels = ["a", "e", "i", "o", "u", "A", "E", "I", "O", "U"]
-    faces = ["(・`ω´・)", ";;w;;", "owo", "UwU", ">w<", "^w^"]
-    msg = msg.replace("L", "W").replace("l", "w")
-    msg = msg.replace("R", "W").replace("r", "w")
+    msg = msg.translate(UWU_TABLE)
 
-    msg = last_replace(msg, "!", "! {}".format(random.choice(faces)))
+    msg = last_replace(msg, "!", "! {}".format(random.choice(UWU_FACES)))
     msg = last_replace(msg, "?", "? owo")
-    msg = last_replace(msg, ".", ". {}".format(random.choice(faces)))
-
-    for v in vowels:
-        if "n{}".format(v) in msg:
-            msg = msg.replace("n{}".format(v), "ny{}".format(v))
-        if "N{}".format(v) in msg:
-            msg = msg.replace(
-                "N{}".format(v), "N{}{}".format("Y" if v.isupper() else "y", v)
-            )
+    msg = last_replace(msg, ".", ". {}".format(random.choice(UWU_FACES)))
 
-    return msg
+    return UWU_NYA_RE.sub(uwu_nya, msg)
 
 
 class MarkovCog(commands.Cog):
@@ -113,14 +338,32 @@ class MarkovCog(commands.Cog):
         self._conn = None  # initialized in on_ready
         self._model = None
         self._model_attrib = None
-        self._pool = concurrent.futures.ProcessPoolExecutor()
+        self._attrib_suffix = None  # appended to sentences from _model
+        # LRU cache of author_id -> (model, pickled size, model file mtime)
+        self._models = OrderedDict()
+        self._models_size = 0  # sum of the pickled sizes in _models
+        self._message_counts = {}  # author_id -> (count, expiry time)
+        self._fresh_models = {}  # author_id -> (model file mtime, expiry time)
+        self._model_tasks = {}  # author_id -> task loading or building its model
+        self._warm_task = None
+        self._pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=POOL_WORKERS, initializer=init_worker
+        )
 
     @commands.Cog.listener()
     async def on_ready(self):
         if self._conn is None:
-            self._conn = await aiosqlite.connect(
-                "file:./discord_archive.sqlite3?mode=ro", uri=True
+            self._conn = await connect_archive()
+
+            # Workers are otherwise started by the first /switch, which then
+            # also pays for starting them.
+            await asyncio.gather(
+                *(
+                    self.bot.loop.run_in_executor(self._pool, warm_worker)
+                    for _ in range(POOL_WORKERS)
+                )
             )
+            self._warm_task = self.bot.loop.create_task(self.warm_models())
 
         if self._model_attrib is None:
             print("Resetting nickname(s)...")
@@ -128,6 +371,27 @@ class MarkovCog(commands.Cog):
                 await guild.me.edit(nick=None)
         print("Ready!")
 
+    async def warm_models(self):
+        """Load or build the models of the most prolific authors.
+
+        Runs in the background after startup, so that switching to them later
+        only has to load a cached model, or nothing at all."""
+        try:
+            cursor = await self._conn.execute(TOP_AUTHORS_SQL, (WARM_MODELS,))
+            author_ids = [row[0] for row in await cursor.fetchall()]
+
+            # Leave room in the pool for /switch while warming up
+            sem = asyncio.Semaphore(max(1, POOL_WORKERS - 1))
+
+            async def warm(author_id):
+                async with sem:
+                    await self.create_model(author_id)
+
+            await asyncio.gather(*(warm(author_id) for author_id in author_ids))
+            print(f"Prepared models for {len(author_ids)} authors")
+        except Exception:
+            logging.exception("Unknown exception in warm_models():")
+
     async def set_name(self, ctx, member):
         """Change nickname to indicate that current model is for member."""
         me = ctx.guild.me
@@ -141,56 +405,104 @@ class MarkovCog(commands.Cog):
             member_name = member.name
 
         trimmed_member = f"{member_name}#{member.discriminator}"
-        self._model_attrib = f"{member.name}#{member.discriminator}"
-
         await me.edit(nick=f"{basename} ({trimmed_member})")
 
-    async def cache_update(self, author_id: int, model_path: str, conn):
-        """Invalidate the cache if author_id has newer messages than the json."""
-        mtime = os.path.getmtime(model_path)
-        cursor = await conn.execute(
-            """
-            SELECT max(timestamp) FROM messages
-            WHERE author_id is ?
-            """,
-            (author_id,),
-        )
-        latest_timestamp = await cursor.fetchone()
+    async def cache_update(self, author_id: int, model_path: str):
+        """Invalidate the cache if author_id has newer messages than the model.
 
-        if latest_timestamp is None:
-            return
+        Return the modification time of model_path if it still holds a cached
+        model, or None."""
+        mtime = await self.bot.loop.run_in_executor(None, model_mtime, model_path)
+        if mtime is None:
+            self.uncache_model(author_id)
+            return None
 
-        if latest_timestamp[0] > mtime:
-            os.remove(model_path)
+        # Skip the query if this file was found current a moment ago
+        now = time.monotonic()
+        checked_mtime, expiry = self._fresh_models.get(author_id, (None, now))
+        if checked_mtime == mtime and now < expiry:
+            return mtime
 
-    async def create_model(self, author_id: int, conn):
-        model_path = os.path.join("models", f"{author_id}.json")
+        cursor = await self._conn.execute(LATEST_TIMESTAMP_SQL, (author_id,))
+        latest_timestamp = await cursor.fetchone()
 
-        try:
-            await self.cache_update(author_id, model_path, conn)
-            with open(model_path, mode="r") as f:
-                model = SentenceText.from_json(f.read())
-        except (FileNotFoundError, json.decoder.JSONDecodeError):
-            cursor = await conn.execute(
-                """
-                SELECT clean_content FROM messages
-                WHERE author_id is ?
-                ORDER BY timestamp DESC
-                LIMIT 100000
-                """,
-                (author_id,),
-            )
-            messages = await cursor.fetchall()
+        if latest_timestamp is not None and latest_timestamp[0] > mtime:
+            await self.bot.loop.run_in_executor(None, remove_model, model_path)
+            self.uncache_model(author_id)
+            self._fresh_models.pop(author_id, None)
+            return None
+
+        self._fresh_models[author_id] = (mtime, now + MODEL_FRESHNESS_TTL)
+        return mtime
+
+    def cache_model(self, author_id: int, model, size: int, mtime: float):
+        """Store model as the most recently used, evicting the oldest models.
+
+        size is the pickled size of model and mtime is the modification time of
+        the file it was saved to. Models are evicted until the total size is
+        within MODEL_CACHE_BYTES. The newest model is always kept."""
+        self.uncache_model(author_id)
+        self._models[author_id] = (model, size, mtime)
+        self._models_size += size
+        while self._models_size > MODEL_CACHE_BYTES and len(self._models) > 1:
+            _, (_, evicted_size, _) = self._models.popitem(last=False)
+            self._models_size -= evicted_size
+
+    def uncache_model(self, author_id: int):
+        """Remove the model for author_id from memory, if it is there."""
+        cached = self._models.pop(author_id, None)
+        if cached is not None:
+            self._models_size -= cached[1]
+
+    async def create_model(self, author_id: int):
+        """Return the model for author_id, loading or building it if needed.
+
+        Concurrent calls for the same author share a single load or build."""
+        task = self._model_tasks.get(author_id)
+        if task is None:
+            task = asyncio.ensure_future(self.load_or_build_model(author_id))
+            self._model_tasks[author_id] = task
+            task.add_done_callback(lambda _: self._model_tasks.pop(author_id))
+        # A cancelled caller must not cancel the load for the others
+        return await asyncio.shield(task)
+
+    async def load_or_build_model(self, author_id: int):
+        model_path = author_model_path(author_id)
+
+        model = None
+        mtime = await self.cache_update(author_id, model_path)
+        if mtime is not None:
+            # A model in memory is only current if the file wasn't replaced
+            # since, e.g. by build_models.py.
+            cached = self._models.get(author_id)
+            if cached is not None and cached[2] == mtime:
+                self._models.move_to_end(author_id)
+                return cached[0]
+
+            try:
+                # Unpickling in the process pool would pickle the model again
+                # to send it back, so use a thread to keep the event loop free.
+                model, size, mtime = await self.bot.loop.run_in_executor(
+                    None, load_model, model_path
+                )
+            except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+                # Corrupt, or removed since the check, so rebuild it
+                pass
 
-            if len(messages) < 25:
+        if model is None:
+            data = await self.bot.loop.run_in_executor(
+                self._pool, build_model, author_id
+            )
+            if data is None:
                 return None
 
-            model = await self.bot.loop.run_in_executor(
-                self._pool, SentenceText, [m[0] for m in messages]
+            mtime = await self.bot.loop.run_in_executor(
+                None, save_model, model_path, data
             )
-            with open(model_path, mode="w") as f:
-                f.write(model.to_json())
+            model = await self.bot.loop.run_in_executor(None, pickle.loads, data)
+            size = len(data)
 
+        self.cache_model(author_id, model, size, mtime)
         return model
 
     @cog_ext.cog_slash(
@@ -212,13 +524,21 @@ class MarkovCog(commands.Cog):
         else:
             member = arg
 
-        new_model = await self.create_model(member.id, self._conn)
+        # Loading or building a model can outlast the time allowed for the
+        # first response to an interaction. Even a model in memory is rebuilt
+        # if the archive has newer messages for its author.
+        await ctx.defer()
+        new_model = await self.create_model(member.id)
 
         if new_model is None:
             await ctx.send(f"Not enough data for user {member.name}")
             return
 
+        # Set together, so that /talk never attributes a sentence to the wrong
+        # author, even if changing the nickname fails.
         self._model = new_model
+        self._model_attrib = f"{member.name}#{member.discriminator}"
+        self._attrib_suffix = f"\n`{self._model_attrib}`"
         await self.set_name(ctx, member)
         await ctx.send(f"Switched model to {member.name}#{member.discriminator}")
 
@@ -236,32 +556,13 @@ class MarkovCog(commands.Cog):
         """Get one sentence from the model, with optional start parameter.
 
         Assumes that a model is active."""
-        TRIES_PER_RATIO = 10
-        make_fn = (
-            functools.partial(self._model.make_sentence_with_start, start)
-            if start
-            else self._model.make_sentence
+        # Generation walks the chain in pure Python, so run it off the event
+        # loop. A thread is used since the model is too big to send to the
+        # process pool on every call.
+        return await self.bot.loop.run_in_executor(
+            None, generate_sentence, self._model, start
         )
 
-        max_overlap_ratio = 0.7
-        while max_overlap_ratio <= 1.0:
-            for _ in range(TRIES_PER_RATIO):
-                sentence = make_fn(max_overlap_ratio=max_overlap_ratio)
-                if sentence:
-                    break
-            else:
-                max_overlap_ratio += 0.1
-                await asyncio.sleep(0)
-                continue
-            break
-
-        # If we still don't get a sentence, just give up and stop testing the
-        # output so that we allow total repeats.
-        if not sentence:
-            sentence = make_fn(test_output=False, strict=False)
-
-        return sentence
-
     @cog_ext.cog_slash(
         name="talk",
         description="Talk command with optional start parameter.",
@@ -307,7 +608,6 @@ class MarkovCog(commands.Cog):
                     ctx, "No active model.", delete_after=None
                 )
 
-            #            async with ctx.typing():
             try:
                 sentence = await self.get_sentence(start)
             except KeyError:
@@ -315,15 +615,16 @@ class MarkovCog(commands.Cog):
                     ctx, f"{start} not found in data set."
                 )
             except markovify.text.ParamError:
-                # TODO: Don't hardcode the number of words here.
                 return await self.react_and_error(
-                    ctx, "At most two words can be used for the start of a sentence."
+                    ctx,
+                    f"At most {self._model.state_size} words can be used for the"
+                    " start of a sentence.",
                 )
 
             if sentence:
                 if uwu:
                     sentence = UWU(sentence)
-                await ctx.send(f"{sentence}\n`{self._model_attrib}`")
+                await ctx.send(sentence + self._attrib_suffix)
             else:
                 await self.react_and_error(
                     ctx, "Gave up after too many failures (too much similarity)."
@@ -337,6 +638,16 @@ class MarkovCog(commands.Cog):
         available_mb = psutil.virtual_memory().available / 1024 / 1024  # MiB
         await ctx.send(f"Memory available: {available_mb} MiB")
 
+    async def message_count(self, author_id: int):
+        """Return the number of messages by author_id, cached for a while."""
+        now = time.monotonic()
+        count, expiry = self._message_counts.get(author_id, (None, now))
+        if expiry <= now:
+            cursor = await self._conn.execute(MESSAGE_COUNT_SQL, (author_id,))
+            (count,) = await cursor.fetchone()
+            self._message_counts[author_id] = (count, now + MESSAGE_COUNT_TTL)
+        return count
+
     @cog_ext.cog_slash(
         name="quote",
         description="Grab a random quote from target, optionally containing keyword.",
@@ -362,17 +673,25 @@ class MarkovCog(commands.Cog):
         else:
             member = target
         author_id = member.id
-        patterns = (
-            (f"%{keyword}%", f"{keyword} %", f"% {keyword}")
-            if keyword
-            else ("%", "%", "%")
-        )
-        query = """
-            SELECT clean_content, timestamp FROM messages WHERE author_id == ?
-            AND (clean_content LIKE ? OR clean_content LIKE ? OR clean_content LIKE ?)
-            ORDER BY RANDOM() LIMIT 1
-        """
-        cursor = await self._conn.execute(query, (author_id,) + patterns)
+        if keyword:
+            pattern = f"%{keyword}%"
+            cursor = None
+            if len(keyword) >= MIN_INDEXED_KEYWORD_LEN:
+                try:
+                    cursor = await self._conn.execute(
+                        QUOTE_KEYWORD_SQL, (pattern, author_id)
+                    )
+                except sqlite3.OperationalError:
+                    # The archive predates the full-text index
+                    pass
+            if cursor is None:
+                cursor = await self._conn.execute(
+                    QUOTE_KEYWORD_LIKE_SQL, (author_id, pattern)
+                )
+        else:
+            count = await self.message_count(author_id)
+            offset = random.randrange(count) if count else 0
+            cursor = await self._conn.execute(QUOTE_SQL, (author_id, offset))
         row = await cursor.fetchone()
         if not row:
             await self.react_and_error(ctx, "No matching quote found")
@@ -426,16 +745,19 @@ class MarkovCog(commands.Cog):
             await msg.edit(content="No results.", components=None)
             return
 
+        # Formatted once, since the buttons revisit the same pages
+        pages = [
+            format_sqlexec(rows[i : i + 10], MAX_MESSAGE_LEN)
+            for i in range(0, len(rows), 10)
+        ]
         base = 0
-        upper = (len(rows) - 1) // 10
+        upper = len(pages) - 1
         edit_fn = msg.edit
         # on the first iteration, we have no interaction context to respond to
         # so we edit the main message
 
         while True:
-            rowslice = rows[base * 10 : base * 10 + 10]
-            message = format_sqlexec(rowslice, MAX_MESSAGE_LEN)
-            await edit_fn(content=message)
+            await edit_fn(content=pages[base])
 
             try:
                 button_ctx = await wait_for_component(
@@ -475,6 +797,9 @@ def main():
         print(f"Using guild commands in guild {debug_guild_id}")
 
     bot = commands.Bot(command_prefix="$")
+    bot.loop.set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=EXECUTOR_THREADS)
+    )
     slash = SlashCommand(  # noqa: F841 needed for side effects
         bot,
         sync_commands=True,